@@ -17,7 +17,6 @@
 
 from __future__ import division
 from __future__ import print_function
-from struct import pack, unpack, calcsize
 
 from impacket import ntlm
 from Cryptodome.Cipher import ARC4
@@ -44,76 +43,119 @@ b'\x2b\x06\x01\x04\x01\x82\x37\x02\x02\x1e': 'NEGOEX - SPNEGO Extended Negotiati
 
 TypesMech = dict((v,k) for k, v in MechTypes.items())
 
-def asn1encode(data = ''):
-        #res = asn1.SEQUENCE(str).encode()
-        #import binascii
-        #print '\nalex asn1encode str: %s\n' % binascii.hexlify(str)
-        if 0 <= len(data) <= 0x7F:
-            res = pack('B', len(data)) + data
-        elif 0x80 <= len(data) <= 0xFF:
-            res = pack('BB', 0x81, len(data)) + data
-        elif 0x100 <= len(data) <= 0xFFFF:
-            res = pack('!BH', 0x82, len(data)) + data
-        elif 0x10000 <= len(data) <= 0xffffff:
-            res = pack('!BBH', 0x83, len(data) >> 16, len(data) & 0xFFFF) + data
-        elif 0x1000000 <= len(data) <= 0xffffffff:
-            res = pack('!BL', 0x84, len(data)) + data
+def _asn1_length(n):
+        # BER length octets for a value of n bytes
+        bl = n.bit_length()
+        if bl <= 7:
+            return bytes((n,))
+        elif bl <= 8:
+            return b'\x81' + bytes((n,))
+        elif bl <= 16:
+            return b'\x82' + n.to_bytes(2, 'big')
+        elif bl <= 24:
+            return b'\x83' + n.to_bytes(3, 'big')
+        elif bl <= 32:
+            return b'\x84' + n.to_bytes(4, 'big')
         else:
             raise Exception('Error in asn1encode')
-        return res
+
+def asn1encode(data = ''):
+        return _asn1_length(len(data)) + data
+
+def _asn1_len(buf, off):
+        # Decodes the BER length starting at buf[off] and returns the
+        # (start, end) offsets of the value it describes
+        len1 = buf[off]
+        if len1 < 0x80:
+            return off + 1, off + 1 + len1
+        pad = len1 & 0x7f
+        start = off + 1 + pad
+        return start, start + int.from_bytes(buf[off + 1:start], 'big')
+
+def _scan_tlvs(buf, start, end):
+        # Flat list of (tag, start, end) for the elements in buf[start:end],
+        # start/end being the offsets of each element's value
+        tlvs = []
+        while start < end:
+            tag = buf[start]
+            value, start = _asn1_len(buf, start + 1)
+            tlvs.append((tag, value, start))
+        return tlvs
 
 def asn1decode(data = ''):
-        len1 = unpack('B', data[:1])[0]
-        data = data[1:]
-        if len1 == 0x81:
-            pad = calcsize('B')
-            len2 = unpack('B',data[:pad])[0]
-            data = data[pad:]
-            ans = data[:len2]
-        elif len1 == 0x82:
-            pad = calcsize('H')
-            len2 = unpack('!H', data[:pad])[0]
-            data = data[pad:]
-            ans = data[:len2]
-        elif len1 == 0x83:
-            pad = calcsize('B') + calcsize('!H')
-            len2, len3 = unpack('!BH', data[:pad])
-            data = data[pad:]
-            ans = data[:len2 << 16 + len3]
-        elif len1 == 0x84:
-            pad = calcsize('!L')
-            len2 = unpack('!L', data[:pad])[0]
-            data = data[pad:]
-            ans = data[:len2]
-        # 1 byte length, string <= 0x7F
-        else:
-            pad = 0
-            ans = data[:len1]
-        return ans, len(ans)+pad+1
+        start, end = _asn1_len(data, 0)
+        ans = data[start:end]
+        return ans, len(ans) + start
+
+def _asn1_header(tag, size):
+        # Single-byte tag followed by the BER length octets for size bytes
+        if size < 0x80:
+            return bytes((tag, size))
+        return bytes((tag,)) + _asn1_length(size)
+
+def _explicit_header(ctx_tag, tag, size):
+        # Headers of a context tag wrapping a single tag/value of size bytes
+        if size < 0x7e:
+            # Both lengths fit in the short form
+            return bytes((ctx_tag, size + 2, tag, size))
+        inner = _asn1_header(tag, size)
+        return _asn1_header(ctx_tag, len(inner) + size) + inner
+
+def _sequence_chunks(tag, parts):
+        # tag { SEQUENCE { parts } } as a chunk list. Lengths are computed
+        # inside-out so the parts are only copied by the caller's final join
+        size = sum(map(len, parts))
+        seq = _asn1_header(ASN1_SEQUENCE, size)
+        return [_asn1_header(tag, len(seq) + size), seq] + parts
+
+def _wrap(tag, payload):
+        # TLV with a single-byte tag
+        return _asn1_header(tag, len(payload)) + payload
+
+# Known mechanisms, already encoded as OID TLVs
+_ENCODED_MECH = {oid: _wrap(ASN1_OID, oid) for oid in MechTypes}
+_ENCODED_SPNEGO_OID = _wrap(ASN1_OID, GSS_API_SPNEGO_UUID)
+
+def _fields(obj):
+        # Names of the slots currently set on a token
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if not name.startswith('_') and getattr(obj, name) is not None:
+                    yield name
 
 class GSSAPI:
 # Generic GSSAPI Header Format 
+    __slots__ = ('UUID', 'OID', 'Payload', '_cache')
+
     def __init__(self, data = None):
-        self.fields = {}
+        # Unset fields are None
+        self._cache = self.OID = self.Payload = None
         self['UUID'] = GSS_API_SPNEGO_UUID
         if data:
              self.fromString(data)
         pass
 
     def __setitem__(self,key,value):
-        self.fields[key] = value
+        setattr(self, key, value)
+        self._cache = None
 
     def __getitem__(self, key):
-        return self.fields[key]
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
 
     def __delitem__(self, key):
-        del self.fields[key]
+        if getattr(self, key, None) is None:
+            raise KeyError(key)
+        setattr(self, key, None)
+        self._cache = None
 
     def __len__(self):
         return len(self.getData())
 
     def __str__(self):
-        return len(self.getData())
+        return self.getData()
 
     def fromString(self, data = None):
         # Manual parse of the GSSAPI Header Format
@@ -123,34 +165,41 @@ class GSSAPI:
         # GSSAPI OID
         # UUID data (BER Encoded)
         # Payload
-        next_byte = unpack('B',data[:1])[0]
+        mv = memoryview(data)
+        next_byte = mv[0]
         if next_byte != ASN1_AID:
             raise Exception('Unknown AID=%x' % next_byte)
-        data = data[1:]
-        decode_data, total_bytes = asn1decode(data) 
+        pos, end = _asn1_len(mv, 1)
         # Now we should have a OID tag
-        next_byte = unpack('B',decode_data[:1])[0]
+        next_byte = mv[pos]
         if next_byte !=  ASN1_OID:
             raise Exception('OID tag not found %x' % next_byte)
-        decode_data = decode_data[1:]
         # Now the OID contents, should be SPNEGO UUID
-        uuid, total_bytes = asn1decode(decode_data)
-        self['OID'] = uuid
+        start, pos = _asn1_len(mv, pos + 1)
+        self['OID'] = bytes(mv[start:pos])
         # the rest should be the data
-        self['Payload'] = decode_data[total_bytes:]
-        #pass
+        self['Payload'] = bytes(mv[pos:end])
 
     def dump(self):
-        for i in list(self.fields.keys()):
+        for i in _fields(self):
             print("%s: {%r}" % (i,self[i]))
 
+    def _emit(self, *payload):
+        # Writes the GSSAPI header in front of the payload chunks, joining
+        # everything once so the payload is not copied per nesting level
+        uuid = self.UUID
+        oid = _ENCODED_SPNEGO_OID if uuid is GSS_API_SPNEGO_UUID else _wrap(ASN1_OID, uuid)
+        size = len(oid) + sum(map(len, payload))
+        return b''.join((_asn1_header(ASN1_AID, size), oid) + payload)
+
     def getData(self):
-        ans = pack('B',ASN1_AID)
-        ans += asn1encode(
-               pack('B',ASN1_OID) + 
-               asn1encode(self['UUID']) +
-               self['Payload'] )
-        return ans
+        # Serialized once and kept until a field is set or deleted
+        if self._cache is None:
+            self._cache = self._build()
+        return self._cache
+
+    def _build(self):
+        return self._emit(self.Payload)
 
 class SPNEGO_NegTokenResp:
     # https://tools.ietf.org/html/rfc4178#page-9
@@ -171,21 +220,37 @@ class SPNEGO_NegTokenResp:
     # This structure is not prepended by a GSS generic header!
     SPNEGO_NEG_TOKEN_RESP = 0xa1
     SPNEGO_NEG_TOKEN_TARG = 0xa0
+    # Context tag -> (field, inner tag, inner tag name)
+    FIELD_TAGS = {
+        SPNEGO_NEG_TOKEN_TARG: ('NegState', ASN1_ENUMERATED, 'Enumerated'),
+        ASN1_SUPPORTED_MECH: ('SupportedMech', ASN1_OID, 'OID'),
+        ASN1_RESPONSE_TOKEN: ('ResponseToken', ASN1_OCTET_STRING, 'Octet string'),
+        ASN1_MECH_LIST_MIC: ('mechListMIC', ASN1_OCTET_STRING, 'Octet string'),
+    }
+    __slots__ = ('NegState', 'SupportedMech', 'ResponseToken', 'mechListMIC', '_cache')
 
     def __init__(self, data = None):
-        self.fields = {}
+        # Unset fields are None
+        self._cache = self.NegState = self.SupportedMech = self.ResponseToken = self.mechListMIC = None
         if data:
              self.fromString(data)
         pass
 
     def __setitem__(self,key,value):
-        self.fields[key] = value
+        setattr(self, key, value)
+        self._cache = None
 
     def __getitem__(self, key):
-        return self.fields[key]
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
 
     def __delitem__(self, key):
-        del self.fields[key]
+        if getattr(self, key, None) is None:
+            raise KeyError(key)
+        setattr(self, key, None)
+        self._cache = None
 
     def __len__(self):
         return len(self.getData())
@@ -194,136 +259,75 @@ class SPNEGO_NegTokenResp:
         return self.getData()
 
     def fromString(self, data = 0):
-        payload = data
-        next_byte = unpack('B', payload[:1])[0]
+        mv = memoryview(data)
+        next_byte = mv[0]
         if next_byte != SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_RESP:
             raise Exception('NegTokenResp not found %x' % next_byte)
-        payload = payload[1:]
-        decode_data, total_bytes = asn1decode(payload)
-        next_byte = unpack('B', decode_data[:1])[0]
+        pos, end = _asn1_len(mv, 1)
+        next_byte = mv[pos]
         if next_byte != ASN1_SEQUENCE:
             raise Exception('SEQUENCE tag not found %x' % next_byte)
-        decode_data = decode_data[1:]
-        decode_data, total_bytes = asn1decode(decode_data)
-        next_byte = unpack('B',decode_data[:1])[0]
-
-        if next_byte != ASN1_MECH_TYPE:
-            # MechType not found, could be an AUTH answer
-            if next_byte != ASN1_RESPONSE_TOKEN:
-               raise Exception('MechType/ResponseToken tag not found %x' % next_byte)
-        else:
-            decode_data2 = decode_data[1:]
-            decode_data2, total_bytes = asn1decode(decode_data2)
-            next_byte = unpack('B', decode_data2[:1])[0]
-            if next_byte != ASN1_ENUMERATED:
-                raise Exception('Enumerated tag not found %x' % next_byte)
-            item, total_bytes2 = asn1decode(decode_data2[1:])
-            self['NegState'] = item
-            decode_data = decode_data[1:]
-            decode_data = decode_data[total_bytes:]
-
-            # Do we have more data?
-            if len(decode_data) == 0:
-                return
-
-            next_byte = unpack('B', decode_data[:1])[0]
-            if next_byte != ASN1_SUPPORTED_MECH:
-                if next_byte != ASN1_RESPONSE_TOKEN:
-                    raise Exception('Supported Mech/ResponseToken tag not found %x' % next_byte)
-            else:
-                decode_data2 = decode_data[1:]
-                decode_data2, total_bytes = asn1decode(decode_data2)
-                next_byte = unpack('B', decode_data2[:1])[0]
-                if next_byte != ASN1_OID:
-                    raise Exception('OID tag not found %x' % next_byte)
-                decode_data2 = decode_data2[1:]
-                item, total_bytes2 = asn1decode(decode_data2)
-                self['SupportedMech'] = item
-
-                decode_data = decode_data[1:]
-                decode_data = decode_data[total_bytes:]
-                next_byte = unpack('B', decode_data[:1])[0]
-                if next_byte != ASN1_RESPONSE_TOKEN:
-                    raise Exception('Response token tag not found %x' % next_byte)
-
-        decode_data = decode_data[1:]
-        decode_data, total_bytes = asn1decode(decode_data)
-        next_byte = unpack('B', decode_data[:1])[0]
-        if next_byte != ASN1_OCTET_STRING:
-            raise Exception('Octet string token tag not found %x' % next_byte)
-        decode_data = decode_data[1:]
-        decode_data, total_bytes = asn1decode(decode_data)
-        self['ResponseToken'] = decode_data
+        pos, end = _asn1_len(mv, pos + 1)
+        for tag, start, stop in _scan_tlvs(mv, pos, end):
+            try:
+                name, inner_tag, label = SPNEGO_NegTokenResp.FIELD_TAGS[tag]
+            except KeyError:
+                raise Exception('Unknown NegTokenResp tag %x' % tag)
+            next_byte = mv[start]
+            if next_byte != inner_tag:
+                raise Exception('%s tag not found %x' % (label, next_byte))
+            start, stop = _asn1_len(mv, start + 1)
+            self[name] = bytes(mv[start:stop])
 
     def dump(self):
-        for i in list(self.fields.keys()):
+        for i in _fields(self):
             print("%s: {%r}" % (i,self[i]))
     def getData(self):
-        ans = pack('B',SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_RESP)
-        if 'NegState' in self.fields and 'SupportedMech' in self.fields and 'ResponseToken' in self.fields:
-            # Server resp
-            ans += asn1encode(
-               pack('B', ASN1_SEQUENCE) +
-               asn1encode(
-               pack('B',SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_TARG) +
-               asn1encode(
-               pack('B',ASN1_ENUMERATED) + 
-               asn1encode( self['NegState'] )) +
-               pack('B',ASN1_SUPPORTED_MECH) +
-               asn1encode( 
-               pack('B',ASN1_OID) +
-               asn1encode(self['SupportedMech'])) +
-               pack('B',ASN1_RESPONSE_TOKEN ) +
-               asn1encode(
-               pack('B', ASN1_OCTET_STRING) + asn1encode(self['ResponseToken']))))
-        elif 'NegState' in self.fields and 'SupportedMech' in self.fields:
-            # Server resp
-            ans += asn1encode(
-               pack('B', ASN1_SEQUENCE) +
-               asn1encode(
-               pack('B',SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_TARG) +
-               asn1encode(
-               pack('B',ASN1_ENUMERATED) +
-               asn1encode( self['NegState'] )) +
-               pack('B',ASN1_SUPPORTED_MECH) +
-               asn1encode(
-               pack('B',ASN1_OID) +
-               asn1encode(self['SupportedMech']))))
-        elif 'NegState' in self.fields:
+        # Serialized once and kept until a field is set or deleted
+        if self._cache is None:
+            self._cache = self._build()
+        return self._cache
+
+    def _build(self):
+        if self.NegState is None and self.mechListMIC is None:
+            # Client resp, by far the most common shape
+            return _emit_client_response_token(self.ResponseToken)
+        if self.NegState is not None:
             # Server resp
-            ans += asn1encode(
-               pack('B', ASN1_SEQUENCE) + 
-               asn1encode(
-               pack('B', SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_TARG) +
-               asn1encode(
-               pack('B',ASN1_ENUMERATED) +
-               asn1encode( self['NegState'] ))))
+            negState = self.NegState
+            parts = [_explicit_header(SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_TARG, ASN1_ENUMERATED, len(negState)),
+                     negState]
+            if self.SupportedMech is not None:
+                supportedMech = self.SupportedMech
+                parts += (_explicit_header(ASN1_SUPPORTED_MECH, ASN1_OID, len(supportedMech)), supportedMech)
+                if self.ResponseToken is not None:
+                    responseToken = self.ResponseToken
+                    parts += (_explicit_header(ASN1_RESPONSE_TOKEN, ASN1_OCTET_STRING, len(responseToken)),
+                              responseToken)
         else:
-            # Client resp
-            if 'mechListMIC' in self.fields:
-                ans += asn1encode(
-                    pack('B', ASN1_SEQUENCE) +
-                    asn1encode(
-                        pack('B', ASN1_RESPONSE_TOKEN) +
-                        asn1encode(
-                            pack('B', ASN1_OCTET_STRING) + 
-                            asn1encode(self['ResponseToken'])
-                        ) +
-                        pack('B', ASN1_MECH_LIST_MIC) +
-                        asn1encode(
-                            pack('B', ASN1_OCTET_STRING) + 
-                            asn1encode(self['mechListMIC'])
-                        )
-                    )
-                )
-            else:
-                ans += asn1encode(
-                    pack('B', ASN1_SEQUENCE) +
-                    asn1encode(
-                    pack('B', ASN1_RESPONSE_TOKEN) +
-                    asn1encode(
-                    pack('B', ASN1_OCTET_STRING) + asn1encode(self['ResponseToken']))))
-        return ans
+            # Client resp with mechListMIC
+            responseToken = self.ResponseToken
+            mechListMIC = self.mechListMIC
+            parts = [_explicit_header(ASN1_RESPONSE_TOKEN, ASN1_OCTET_STRING, len(responseToken)), responseToken,
+                     _explicit_header(ASN1_MECH_LIST_MIC, ASN1_OCTET_STRING, len(mechListMIC)), mechListMIC]
+
+        return b''.join(_sequence_chunks(SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_RESP, parts))
+
+_CLIENT_RESP_TAGS = (bytes((SPNEGO_NegTokenResp.SPNEGO_NEG_TOKEN_RESP,)), bytes((ASN1_SEQUENCE,)),
+                     bytes((ASN1_RESPONSE_TOKEN,)), bytes((ASN1_OCTET_STRING,)))
+
+def _emit_client_response_token(token):
+        # NegTokenResp { responseToken } without the nested _wrap calls:
+        # lengths are computed inside-out and everything is joined once
+        resp_tag, seq_tag, token_tag, octet_tag = _CLIENT_RESP_TAGS
+        octet_len = _asn1_length(len(token))
+        size = 1 + len(octet_len) + len(token)
+        token_len = _asn1_length(size)
+        size += 1 + len(token_len)
+        seq_len = _asn1_length(size)
+        size += 1 + len(seq_len)
+        return b''.join((resp_tag, _asn1_length(size), seq_tag, seq_len, token_tag, token_len,
+                         octet_tag, octet_len, token))
 
 class SPNEGO_NegTokenInit(GSSAPI):
     # https://tools.ietf.org/html/rfc4178#page-8
@@ -334,110 +338,103 @@ class SPNEGO_NegTokenInit(GSSAPI):
     #   mechListMIC     [3] OCTET STRING OPTIONAL,
     # }
     SPNEGO_NEG_TOKEN_INIT = 0xa0
+    __slots__ = ('MechTypes', 'MechToken')
+
+    def __init__(self, data = None):
+        self.MechTypes = self.MechToken = None
+        GSSAPI.__init__(self, data)
+
+    def __setitem__(self, key, value):
+        # Kept as a tuple so the list can't change behind the getData() cache
+        if key == 'MechTypes' and value is not None:
+            value = tuple(value)
+        GSSAPI.__setitem__(self, key, value)
+
     def fromString(self, data = 0):
         GSSAPI.fromString(self, data)
-        payload = self['Payload']
-        next_byte = unpack('B', payload[:1])[0] 
+        mv = memoryview(self.Payload)
+        next_byte = mv[0]
         if next_byte != SPNEGO_NegTokenInit.SPNEGO_NEG_TOKEN_INIT:
             raise Exception('NegTokenInit not found %x' % next_byte)
-        payload = payload[1:]
-        decode_data, total_bytes = asn1decode(payload)
+        pos, end = _asn1_len(mv, 1)
         # Now we should have a SEQUENCE Tag
-        next_byte = unpack('B', decode_data[:1])[0]
+        next_byte = mv[pos]
         if next_byte != ASN1_SEQUENCE:
             raise Exception('SEQUENCE tag not found %x' % next_byte)
-        decode_data = decode_data[1:]
-        decode_data, total_bytes2 = asn1decode(decode_data)
-        next_byte = unpack('B',decode_data[:1])[0]
+        pos, end = _asn1_len(mv, pos + 1)
+        next_byte = mv[pos]
         if next_byte != ASN1_MECH_TYPE:
             raise Exception('MechType tag not found %x' % next_byte)
-        decode_data = decode_data[1:]
-        remaining_data = decode_data
-        decode_data, total_bytes3 = asn1decode(decode_data)
-        next_byte = unpack('B', decode_data[:1])[0]
+        pos, next_pos = _asn1_len(mv, pos + 1)
+        next_byte = mv[pos]
         if next_byte != ASN1_SEQUENCE:
             raise Exception('SEQUENCE tag not found %x' % next_byte)
-        decode_data = decode_data[1:]
-        decode_data, total_bytes4 = asn1decode(decode_data)
+        pos, seq_end = _asn1_len(mv, pos + 1)
         # And finally we should have the MechTypes
-        self['MechTypes'] = []
-        while decode_data:
-           next_byte = unpack('B', decode_data[:1])[0]
-           if next_byte != ASN1_OID:    
-             # Not a valid OID, there must be something else we won't unpack
-             break
-           decode_data = decode_data[1:]
-           item, total_bytes = asn1decode(decode_data)
-           self['MechTypes'].append(item)
-           decode_data = decode_data[total_bytes:]
+        # MechTypeList ::= SEQUENCE OF MechType, so the SEQUENCE length bounds the walk
+        mechTypes = []
+        while pos < seq_end:
+            if mv[pos] != ASN1_OID:
+                raise Exception('OID tag not found %x' % mv[pos])
+            start, pos = _asn1_len(mv, pos + 1)
+            mechTypes.append(bytes(mv[start:pos]))
+        self['MechTypes'] = mechTypes
 
         # Do we have MechTokens as well?
-        decode_data = remaining_data[total_bytes3:]
-        if len(decode_data) > 0:
-            next_byte = unpack('B', decode_data[:1])[0]
+        pos = next_pos
+        if pos < end:
+            next_byte = mv[pos]
             if next_byte == ASN1_MECH_TOKEN:
                 # We have tokens in here!
-                decode_data = decode_data[1:]
-                decode_data, total_bytes = asn1decode(decode_data)
-                next_byte = unpack('B', decode_data[:1])[0]
+                start, stop = _asn1_len(mv, pos + 1)
+                next_byte = mv[start]
                 if next_byte ==  ASN1_OCTET_STRING:
-                    decode_data = decode_data[1:]
-                    decode_data, total_bytes = asn1decode(decode_data)
-                    self['MechToken'] =  decode_data
+                    start, stop = _asn1_len(mv, start + 1)
+                    self['MechToken'] = bytes(mv[start:stop])
 
-    def getData(self):
-        mechTypes = b''
-        for i in self['MechTypes']:
-            mechTypes += pack('B', ASN1_OID)
-            mechTypes += asn1encode(i)
+    def _build(self):
+        mechTypes = b''.join([_ENCODED_MECH.get(i) or _wrap(ASN1_OID, i) for i in self.MechTypes])
 
-        mechToken = b''
+        parts = [_explicit_header(ASN1_MECH_TYPE, ASN1_SEQUENCE, len(mechTypes)), mechTypes]
         # Do we have tokens to send?
-        if 'MechToken' in self.fields:
-            mechToken = pack('B', ASN1_MECH_TOKEN) + asn1encode(
-                pack('B', ASN1_OCTET_STRING) + asn1encode(
-                    self['MechToken']))
-
-        ans = pack('B',SPNEGO_NegTokenInit.SPNEGO_NEG_TOKEN_INIT)
-        ans += asn1encode(
-               pack('B', ASN1_SEQUENCE) +
-               asn1encode(
-               pack('B', ASN1_MECH_TYPE) +
-               asn1encode(
-               pack('B', ASN1_SEQUENCE) + 
-               asn1encode(mechTypes)) + mechToken ))
+        if self.MechToken is not None:
+            mechToken = self.MechToken
+            parts += (_explicit_header(ASN1_MECH_TOKEN, ASN1_OCTET_STRING, len(mechToken)), mechToken)
 
-
-        self['Payload'] = ans
-        return GSSAPI.getData(self)
+        return self._emit(*_sequence_chunks(SPNEGO_NegTokenInit.SPNEGO_NEG_TOKEN_INIT, parts))
 
 class SPNEGOCipher:
     def __init__(self, flags, randomSessionKey):
         self.__flags = flags
-        if self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
+        self._seal = ntlm.SEAL
+        self._mac = ntlm.MAC
+        self._ext = bool(self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY)
+        if self._ext:
             self.__clientSigningKey = ntlm.SIGNKEY(self.__flags, randomSessionKey)
             self.__serverSigningKey = ntlm.SIGNKEY(self.__flags, randomSessionKey,"Server")
             self.__clientSealingKey = ntlm.SEALKEY(self.__flags, randomSessionKey)
             self.__serverSealingKey = ntlm.SEALKEY(self.__flags, randomSessionKey,"Server")
-            
-            # Preparing the keys handle states
-            cipher3 = ARC4.new(self.__clientSealingKey)
-            self.__clientSealingHandle = cipher3.encrypt
-            cipher4 = ARC4.new(self.__serverSealingKey)
-            self.__serverSealingHandle = cipher4.encrypt
+            # The server handle is keyed lazily in decrypt(), a reset only
+            # pays for the key schedule of the side that is actually used
+            self._resetter = lambda: (ARC4.new(self.__clientSealingKey).encrypt, None)
         else:
             # Same key for everything
             self.__clientSigningKey = randomSessionKey
             self.__serverSigningKey = randomSessionKey
             self.__clientSealingKey = randomSessionKey
-            self.__clientSealingKey = randomSessionKey
-            cipher = ARC4.new(self.__clientSigningKey)
-            self.__clientSealingHandle = cipher.encrypt
-            self.__serverSealingHandle = cipher.encrypt
+            self.__serverSealingKey = randomSessionKey
+            def resetter():
+                handle = ARC4.new(self.__clientSigningKey).encrypt
+                return handle, handle
+            self._resetter = resetter
+        # Preparing the keys handle states
+        self.__clientSealingHandle, self.__serverSealingHandle = self._resetter()
         self.__sequence = 0
 
     def encrypt(self, plain_data):
-        sealedMessage, signature =  ntlm.SEAL(self.__flags, 
+        # The whole message goes through the ARC4 handle in a single call,
+        # the keystream XOR is done by PyCryptodome
+        sealedMessage, signature = self._seal(self.__flags,
                 self.__clientSigningKey, 
                 self.__clientSealingKey,  
                 plain_data, 
@@ -450,7 +447,9 @@ class SPNEGOCipher:
         return signature, sealedMessage
 
     def decrypt(self, answer):
-        answer, signature =  ntlm.SEAL(self.__flags, 
+        if self.__serverSealingHandle is None:
+            self.__serverSealingHandle = ARC4.new(self.__serverSealingKey).encrypt
+        answer, signature = self._seal(self.__flags,
                 self.__serverSigningKey, 
                 self.__serverSealingKey,  
                 answer[:16], 
@@ -461,16 +460,8 @@ class SPNEGOCipher:
         return signature, answer
     
     def sign(self,data, seqNum=0, reset_cipher=False):
-        signature = ntlm.MAC(self.__flags, self.__clientSealingHandle, self.__clientSigningKey, seqNum, data)
+        signature = self._mac(self.__flags, self.__clientSealingHandle, self.__clientSigningKey, seqNum, data)
         if reset_cipher:
-            if self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
-                cipher3 = ARC4.new(self.__clientSealingKey)
-                self.__clientSealingHandle = cipher3.encrypt
-                cipher4 = ARC4.new(self.__serverSealingKey)
-                self.__serverSealingHandle = cipher4.encrypt
-            else:
-                cipher = ARC4.new(self.__clientSigningKey)
-                self.__clientSealingHandle = cipher.encrypt
-                self.__serverSealingHandle = cipher.encrypt
+            self.__clientSealingHandle, self.__serverSealingHandle = self._resetter()
         self.__sequence += 1
         return signature
@@ -9,7 +9,9 @@
 # for more information.
 #
 import unittest
-from impacket import smb
+from Cryptodome.Cipher import ARC4
+from impacket import smb, ntlm
+from impacket.spnego import asn1encode, asn1decode, SPNEGOCipher
 
 
 class Test(unittest.TestCase):
@@ -58,6 +60,107 @@ class Test(unittest.TestCase):
         token['SupportedMech'] = smb.TypesMech['NTLMSSP - Microsoft NTLM Security Support Provider']
         self.assertEqual(self.negTokenResp4, token.getData())
 
+    def test_negTokenResp4_parse(self):
+        token = smb.SPNEGO_NegTokenResp()
+        token.fromString(self.negTokenResp4)
+        self.assertEqual(b'\x03', token['NegState'])
+        self.assertEqual(smb.TypesMech['NTLMSSP - Microsoft NTLM Security Support Provider'], token['SupportedMech'])
+        self.assertEqual(self.negTokenResp4, token.getData())
+
+    def test_negTokenResp_mechListMIC(self):
+        token = smb.SPNEGO_NegTokenResp()
+        token['ResponseToken'] = b'NTLMSSP\x00'
+        token['mechListMIC'] = b'\x01' * 16
+        parsed = smb.SPNEGO_NegTokenResp(token.getData())
+        self.assertEqual(b'NTLMSSP\x00', parsed['ResponseToken'])
+        self.assertEqual(b'\x01' * 16, parsed['mechListMIC'])
+        self.assertEqual(token.getData(), parsed.getData())
+
+    def test_unset_fields(self):
+        token = smb.SPNEGO_NegTokenResp()
+        token.fromString(self.negTokenResp3)
+        self.assertEqual(b'\x00', token['NegState'])
+        self.assertRaises(KeyError, token.__getitem__, 'ResponseToken')
+        del token['NegState']
+        self.assertRaises(KeyError, token.__getitem__, 'NegState')
+        self.assertRaises(KeyError, token.__delitem__, 'NegState')
+
+    def test_getData_cache(self):
+        token = smb.SPNEGO_NegTokenResp()
+        token.fromString(self.negTokenResp2)
+        data = token.getData()
+        self.assertIs(data, token.getData())
+        self.assertEqual(len(data), len(token))
+        token['ResponseToken'] = b'NTLMSSP\x00'
+        self.assertEqual(b'\xa1\x0e\x30\x0c\xa2\x0a\x04\x08NTLMSSP\x00', token.getData())
+
+    def test_getData_cache_mechTypes(self):
+        token = smb.SPNEGO_NegTokenInit()
+        mechTypes = []
+        token['MechTypes'] = mechTypes
+        len(token)
+        # The token keeps its own copy, mutating the caller's list has no effect
+        mechTypes.append(smb.TypesMech['NTLMSSP - Microsoft NTLM Security Support Provider'])
+        self.assertEqual((), token['MechTypes'])
+        self.assertIsInstance(token['MechTypes'], tuple)
+        token['MechTypes'] = mechTypes
+        self.assertEqual(tuple(mechTypes), smb.SPNEGO_NegTokenInit(token.getData())['MechTypes'])
+
+    def test_asn1encode(self):
+        for size in (0, 0x7f, 0x80, 0xff, 0x100, 0xffff, 0x10000, 0x12345):
+            blob = b'\x41' * size
+            self.assertEqual(self._encode_length(size) + blob, asn1encode(blob))
+
+    def test_asn1decode(self):
+        for size in (0x10, 0x90, 0x1234, 0x12345):
+            blob = b'\x41' * size
+            encoded = self._encode_length(size)
+            data, total = asn1decode(encoded + blob + b'\xff')
+            self.assertEqual(blob, data)
+            self.assertEqual(len(encoded) + size, total)
+
+    def test_cipher_sign_reset_then_decrypt(self):
+        # Reference values produced by the original SPNEGOCipher, which
+        # re-keyed both ARC4 handles on every sign(reset_cipher=True)
+        flags = ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY | ntlm.NTLMSSP_NEGOTIATE_KEY_EXCH | \
+                ntlm.NTLMSSP_NEGOTIATE_128
+        cipher = SPNEGOCipher(flags, bytes(range(16)))
+
+        signature, sealed = cipher.encrypt(b'plain data')
+        self.assertEqual(bytes.fromhex('010000004db569e72966d96c00000000'), signature.getData())
+        self.assertEqual(bytes.fromhex('046efa3a1f61396362aa'), sealed)
+
+        signature = cipher.sign(b'to sign', 1, reset_cipher=True)
+        self.assertEqual(bytes.fromhex('01000000e40875fafa28350701000000'), signature.getData())
+        signature, plain = cipher.decrypt(b'\xaa' * 16 + b'server data')
+        self.assertEqual(bytes.fromhex('01000000d6ad6087a952486202000000'), signature.getData())
+        self.assertEqual(bytes.fromhex('220aadfbd4a4398144ac41'), plain)
+
+        signature = cipher.sign(b'to sign', 2, reset_cipher=True)
+        self.assertEqual(bytes.fromhex('01000000b48e2af7e20edc0002000000'), signature.getData())
+        signature, plain = cipher.decrypt(b'\xbb' * 16 + b'server data')
+        self.assertEqual(bytes.fromhex('010000007fba6c226ad77cce03000000'), signature.getData())
+        self.assertEqual(bytes.fromhex('220aadfbd4a4398144ac41'), plain)
+
+    def test_cipher_decrypt_no_extended_session_security(self):
+        # Without extended session security one ARC4 stream keyed with the
+        # session key is shared by both directions
+        key = bytes(range(16))
+        answer = b'\xaa' * 16 + b'server data'
+        cipher = SPNEGOCipher(0, key)
+        signature, plain = cipher.decrypt(answer)
+        expected_plain, expected_signature = ntlm.SEAL(0, key, key, answer[:16], answer[16:], 0,
+                                                       ARC4.new(key).encrypt)
+        self.assertEqual(expected_plain, plain)
+        self.assertEqual(expected_signature.getData(), signature.getData())
+
+    @staticmethod
+    def _encode_length(size):
+        if size <= 0x7f:
+            return bytes((size,))
+        raw = size.to_bytes((size.bit_length() + 7) // 8, 'big')
+        return bytes((0x80 | len(raw),)) + raw
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=1)